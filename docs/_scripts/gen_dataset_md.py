@@ -1,30 +1,43 @@
 import json
-import os
 import re
 from collections import defaultdict
+from pathlib import Path
 
 import gymnasium as gym
 from google.cloud import storage  # pyright: ignore [reportGeneralTypeIssues]
 
 from minari import list_remote_datasets
 from minari.dataset.minari_dataset import parse_dataset_id
-from minari.storage.hosting import find_highest_remote_version
+
+
+SPACES_RE = re.compile(" +")
+DATASETS_DOCS_DIR = Path(__file__).parent.parent / "datasets"
 
 
 filtered_datasets = defaultdict(defaultdict)
 all_remote_datasets = list_remote_datasets()
 
+# Find the highest version of each dataset from the remote ids already fetched
+max_versions = defaultdict(dict)
 for dataset_id in all_remote_datasets.keys():
 
     env_name, dataset_name, version = parse_dataset_id(dataset_id)
 
-    if dataset_name not in filtered_datasets[env_name]:
-        max_version = find_highest_remote_version(env_name, dataset_name)
+    if version is not None:
+        max_versions[env_name][dataset_name] = max(
+            version, max_versions[env_name].get(dataset_name, version)
+        )
+
+for env_name, dataset_versions in max_versions.items():
+    for dataset_name, max_version in dataset_versions.items():
         max_version_dataset_id = "-".join([env_name, dataset_name, f"v{max_version}"])
         filtered_datasets[env_name][dataset_name] = all_remote_datasets[
             max_version_dataset_id
         ]
 
+# Action and observation space descriptions by environment id, shared between datasets
+env_space_tables = {}
+
 for env_name, datasets in filtered_datasets.items():
     available_datasets = """
 ## Available Datasets
@@ -32,6 +45,9 @@ for env_name, datasets in filtered_datasets.items():
 | ---------- | ----------- |
 """
 
+    dataset_doc_path = DATASETS_DOCS_DIR / env_name
+    dataset_doc_path.mkdir(parents=True, exist_ok=True)
+
     for i, (dataset_name, dataset_spec) in enumerate(datasets.items()):
         if i == 0:
             related_pages_meta = "firstpage:\n"
@@ -76,10 +92,15 @@ for env_name, datasets in filtered_datasets.items():
         # Environment Specs
         env_spec = json.loads(dataset_spec["env_spec"])
         env_id = env_spec["id"]
-        env = gym.make(env_id)
+        if env_id not in env_space_tables:
+            env = gym.make(env_id)
+            env_space_tables[env_id] = (
+                SPACES_RE.sub(" ", env.action_space.__repr__().replace("\n", "")),
+                SPACES_RE.sub(" ", env.observation_space.__repr__().replace("\n", "")),
+            )
+            env.close()
 
-        action_space_table = env.action_space.__repr__().replace("\n", "")
-        observation_space_table = env.observation_space.__repr__().replace("\n", "")
+        action_space_table, observation_space_table = env_space_tables[env_id]
 
         env_page = f"""---
 autogenerated:
@@ -113,30 +134,12 @@ title: {dataset_name.title()}
 |    |    |
 |----|----|
 |ID| `{env_id}`|
-| Action Space | `{re.sub(' +', ' ', action_space_table)}` |
-| Observation Space | `{re.sub(' +', ' ', observation_space_table)}` |
+| Action Space | `{action_space_table}` |
+| Observation Space | `{observation_space_table}` |
 
 """
 
-        dataset_doc_path = os.path.join(
-            os.path.dirname(__file__), "..", "datasets", env_name
-        )
-
-        if not os.path.exists(dataset_doc_path):
-            os.makedirs(dataset_doc_path)
-
-        dataset_md_path = os.path.join(
-            dataset_doc_path,
-            dataset_name + ".md",
-        )
-
-        file = open(dataset_md_path, "w", encoding="utf-8")
-        file.write(env_page)
-        file.close()
+        (dataset_doc_path / f"{dataset_name}.md").write_text(env_page, encoding="utf-8")
 
-    env_page_path = os.path.join(
-        os.path.dirname(__file__), "..", "datasets", f"{env_name}.md"
-    )
-    file = open(env_page_path, "a", encoding="utf-8")
-    file.write(available_datasets)
-    file.close()
+    with open(DATASETS_DOCS_DIR / f"{env_name}.md", "a", encoding="utf-8") as file:
+        file.write(available_datasets)
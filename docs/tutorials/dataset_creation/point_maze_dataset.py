@@ -9,8 +9,8 @@ PointMaze D4RL dataset
 # MuJoCo python bindings.
 #
 # Lets start by breaking down the steps to generate these datasets:
-#   1. First we need to create a planner that outputs a trajectory of waypoints that the agent can follow to reach the goal from its initial location in the maze. We will be using
-#      `Q-Value Iteration <https://towardsdatascience.com/fundamental-iterative-methods-of-reinforcement-learning-df8ff078652a>`_ [2] to solve the discrete grid maze, same as in D4RL.
+#   1. First we need to create a planner that outputs a trajectory of waypoints that the agent can follow to reach the goal from its initial location in the maze. We will solve the discrete grid maze
+#      with a breadth first search, which gives the same waypoints as the `Q-Value Iteration <https://towardsdatascience.com/fundamental-iterative-methods-of-reinforcement-learning-df8ff078652a>`_ [2] used in D4RL.
 #   2. Then we also need to generate the actions so that the agent can follow the waypoints of the trajectory. For this purpose D4RL implements a PD controller.
 #   3. Finally, to create the Minari dataset, we will wrap the environment with a :class:`minari.DataCollectorV0` and step through it by generating actions with the path planner and waypoint controller.
 #
@@ -20,6 +20,8 @@ PointMaze D4RL dataset
 #
 # Lets start by importing the required modules for this tutorial:
 
+from collections import deque
+
 import gymnasium as gym
 import numpy as np
 
@@ -35,9 +37,10 @@ from minari import DataCollectorV0, StepDataCallback
 # the size of the state space. The action space for this solver will also be reduced to ``UP``, ``DOWN``, ``LEFT``,
 # and ``RIGHT``. The solution trajectories will then be a set of waypoints that the agent has to follow to reach the
 # goal.
-# We can simply use a variation of Dynamic Programming to generate the trajectories. The method chosen in the D4RL[1] publication
-# is that of Value Iteration, specifically Q-Value Iteration[2]. We will obtain the optimal Q-values by doing a series of Bellman
-# updates (``50`` in total) of the form:
+# Our planner generates the trajectories with a breadth first search from the goal cell. The method chosen in the D4RL[1] publication
+# is a variation of Dynamic Programming, Q-Value Iteration[2], and the search gives the same policy. Let's first look at Q-Value Iteration,
+# which is kept in the method ``get_q_values(goal_cell)`` only as a reference of the D4RL planner. It obtains the optimal Q-values by doing
+# a series of Bellman updates (``50`` in total) of the form:
 #
 # .. math::
 #   Q'(s, a) \leftarrow \sum_{s'}T(s,a,s')[R(s,a,s') + \gamma\max_{a'}Q(s',a')]
@@ -45,12 +48,20 @@ from minari import DataCollectorV0, StepDataCallback
 # **T(s,a,s')** is the transition matrix which gives the probability of reaching state **s'** when taking action **a** from state **s**.
 # We consider the grid maze a deterministic space which means that if **s'** is an empty cell **T(s,a,s')** will have a value of ``1`` since
 # we know that the agent will always reach that state. On the other hand, if the state **s'** is a wall the value of **T(s,a,s')** will be ``0``.
+# Because of this, at most one entry of **T(s,a,·)** is non-zero and instead of storing the full matrix we only keep the index of the next state
+# ``next_state[s, a]`` and a boolean mask ``valid_mask[s, a]`` telling if the move is allowed. The sum over **s'** then becomes a single lookup.
 #
 # Once we have the optimal Q-values (**Q***) we can generate a waypoint trajectory with the following policy:
 #
 # .. math::
 #   \pi(s) = arg\max_{a}Q^{*}(s,a)
 #
+# Since the maze is deterministic and the only reward is given when reaching the goal, this greedy policy always moves to
+# the neighbor cell with the shortest path to the goal (ties are broken in the same action order). Our planner takes advantage
+# of this and obtains the policy with a single breadth first search from the goal cell, which visits every cell once instead of
+# running the ``50`` Bellman updates. The goals are always one of the cells of the maze, so the policy obtained for each goal cell
+# is cached and only computed the first time a goal is seen.
+#
 # The class below, ``QIteration``, gives access to the method ``generate_path(current_cell, goal_cell)``.  This method returns a dictionary of waypoints
 # such as:
 #
@@ -66,99 +77,128 @@ DOWN = 1
 LEFT = 2
 RIGHT = 3
 
-EXPLORATION_ACTIONS = {UP: (0, 1), DOWN: (0, -1), LEFT: (-1, 0), RIGHT: (1, 0)}
+# Cell displacement of each action, indexed by the action id
+EXPLORATION_ACTIONS = np.array([[0, 1], [0, -1], [-1, 0], [1, 0]], dtype=np.int8)
 
 
 class QIteration:
-    """Solves for optimal policy with Q-Value Iteration.
+    """Solves for optimal policy of the grid maze.
+
+    The waypoint policy is obtained with a breadth first search, Q-Value Iteration is kept as reference in ``get_q_values``.
 
     Inspired by https://github.com/Farama-Foundation/D4RL/blob/master/d4rl/pointmaze/q_iteration.py
     """
     def __init__(self, maze):
         self.maze = maze
         self.num_states = maze.map_length * maze.map_width
-        self.num_actions = len(EXPLORATION_ACTIONS.keys())
-        self.rew_matrix = np.zeros((self.num_states, self.num_actions))
+        self.num_actions = len(EXPLORATION_ACTIONS)
         self.compute_transition_matrix()
+        # Greedy policy for each goal cell already solved
+        self._policy_cache = {}
+
+    def get_policy(self, goal_cell):
+        policy = self._policy_cache.get(goal_cell)
+        if policy is None:
+            policy = self._bfs_policy(goal_cell)
+            self._policy_cache[goal_cell] = policy
+        return policy
+
+    def _bfs_policy(self, goal_cell):
+        """Greedy policy that moves to the neighbor cell with the shortest distance to ``goal_cell``.
+
+        Same policy as argmax_a Q*(s, a) for this deterministic maze, with the distances computed by
+        a breadth first search from the goal.
+        """
+        next_state = self.next_state.tolist()
+        valid_mask = self.valid_mask.tolist()
+        # No path is longer than num_states, use it as the distance of unreachable cells
+        unreachable = self.num_states
+        dist = [unreachable] * self.num_states
+
+        goal_state = self.cell_to_state(goal_cell)
+        dist[goal_state] = 0
+        queue = deque([goal_state])
+        while queue:
+            state = queue.popleft()
+            # Moves between empty cells are reversible, so the neighbors of a state can also reach it
+            for neighbor, valid in zip(next_state[state], valid_mask[state]):
+                if valid and dist[neighbor] == unreachable:
+                    dist[neighbor] = dist[state] + 1
+                    queue.append(neighbor)
+
+        next_dist = np.where(self.valid_mask, np.array(dist)[self.next_state], unreachable)
+        return np.argmin(next_dist, axis=1).astype(np.int32)
 
     def generate_path(self, current_cell, goal_cell):
-        self.compute_reward_matrix(goal_cell)
-        q_values = self.get_q_values()
+        policy = self.get_policy(goal_cell)
+        map_width = self.maze.map_width
         current_state = self.cell_to_state(current_cell)
         waypoints = {}
         while True:
-            action_id = np.argmax(q_values[current_state])
-            next_state, _ = self.get_next_state(current_state, EXPLORATION_ACTIONS[action_id])
-            current_cell = self.state_to_cell(current_state)
-            waypoints[current_cell] = self.state_to_cell(next_state)
-            if waypoints[current_cell] == goal_cell:
+            # Follow the policy through the precomputed next state table
+            next_state = int(self.next_state[current_state, policy[current_state]])
+            next_cell = divmod(next_state, map_width)
+            waypoints[divmod(current_state, map_width)] = next_cell
+            if next_cell == goal_cell:
                 break
 
             current_state = next_state
 
         return waypoints
 
-    def reward_function(self, desired_cell, current_cell):
-        if desired_cell == current_cell:
-            return 1.0
-        else:
-            return 0.0
-
-    def state_to_cell(self, state):
-        i = int(state/self.maze.map_width)
-        j = state % self.maze.map_width
-        return (i, j)
-
     def cell_to_state(self, cell):
         return cell[0] * self.maze.map_width + cell[1]
 
-    def get_q_values(self, num_itrs=50, discount=0.99):
-        q_fn = np.zeros((self.num_states, self.num_actions))
+    def get_q_values(self, goal_cell, num_itrs=50, discount=0.99):
+        rew_matrix = self.compute_reward_matrix(goal_cell)
+        # The Q-values are only used through argmax, single precision is enough.
+        # Cast the discount too, otherwise the updates would be promoted to float64.
+        discount = np.float32(discount)
+        # Buffers are allocated once and updated in place by every iteration
+        q_fn = np.zeros((self.num_states, self.num_actions), dtype=np.float32)
+        v_fn = np.empty(self.num_states, dtype=np.float32)
+        next_v = np.empty_like(q_fn)
         for _ in range(num_itrs):
-            v_fn = np.max(q_fn, axis=1)
-            q_fn = self.rew_matrix + discount*self.transition_matrix.dot(v_fn)
+            np.max(q_fn, axis=1, out=v_fn)
+            np.take(v_fn, self.next_state, out=next_v)
+            next_v *= discount
+            # Invalid moves don't reach any state, only the immediate reward is kept
+            next_v *= self.valid_mask
+            np.add(rew_matrix, next_v, out=q_fn)
         return q_fn
 
     def compute_reward_matrix(self, goal_cell):
-        for state in range(self.num_states):
-            for action in range(self.num_actions):
-                next_state, _ = self.get_next_state(state, EXPLORATION_ACTIONS[action])
-                next_cell = self.state_to_cell(next_state)
-                self.rew_matrix[state, action] = self.reward_function(goal_cell, next_cell)
+        # Reward of 1 for every valid move that lands in the goal cell
+        goal_state = self.cell_to_state(goal_cell)
+        return ((self.next_state == goal_state) & self.valid_mask).astype(np.float32)
 
     def compute_transition_matrix(self):
-        """Constructs this environment's transition matrix.
-        Returns:
-          A dS x dA x dS array where the entry transition_matrix[s, a, ns]
-          corresponds to the probability of transitioning into state ns after taking
-          action a from state s.
-        """
-        self.transition_matrix = np.zeros((self.num_states, self.num_actions, self.num_states))
-        for state in range(self.num_states):
-            for action_idx, action in EXPLORATION_ACTIONS.items():
-                next_state, valid = self.get_next_state(state, action)
-                if valid:
-                    self.transition_matrix[state, action_idx, next_state] = 1
+        """Constructs this environment's transition table.
 
-    def get_next_state(self, state, action):
-        cell = self.state_to_cell(state)
-
-        next_cell = tuple(map(lambda i, j: int(i + j), cell, action))
-        next_state = self.cell_to_state(next_cell)
-
-        return next_state, self._check_valid_cell(next_cell)
-
-    def _check_valid_cell(self, cell):
+        The maze is deterministic, so instead of a dense dS x dA x dS probability tensor we store:
+          next_state: A dS x dA int array where the entry next_state[s, a] is the state reached
+            after taking action a from state s.
+          valid_mask: A dS x dA bool array, False where action a from state s hits a wall or leaves
+            the map. The matching next_state entry is left pointing at s.
+        """
+        map_length, map_width = self.maze.map_length, self.maze.map_width
+        # The map can also hold string cells (e.g. goal/reset locations), compare element-wise
+        wall = np.array([[cell == 1 for cell in row] for row in self.maze.maze_map])
+        # Row and column index of every cell in the maze grid
+        i_idx, j_idx = np.meshgrid(np.arange(map_length), np.arange(map_width), indexing='ij')
+        states = i_idx * map_width + j_idx
+
+        # Broadcast the displacement of every action over the grid, map_length x map_width x dA arrays
+        next_i = i_idx[..., None] + EXPLORATION_ACTIONS[:, 0]
+        next_j = j_idx[..., None] + EXPLORATION_ACTIONS[:, 1]
         # Out of map bounds
-        if cell[0] >= self.maze.map_length:
-            return False
-        elif cell[1] >= self.maze.map_width:
-            return False
+        valid = (next_i >= 0) & (next_i < map_length) & (next_j >= 0) & (next_j < map_width)
         # Wall collision
-        elif self.maze.maze_map[cell[0]][cell[1]] == 1:
-            return False
-        else:
-            return True
+        valid[valid] = ~wall[next_i[valid], next_j[valid]]
+
+        next_state = np.where(valid, next_i * map_width + next_j, states[..., None])
+        self.next_state = next_state.reshape(self.num_states, self.num_actions).astype(np.int32)
+        self.valid_mask = valid.reshape(self.num_states, self.num_actions)
 
 
 # %%
@@ -186,18 +226,41 @@ class WaypointController:
         self.maze = maze
 
         self.maze_solver = QIteration(maze=self.maze)
+        # Continuous xy coordinates of the center of each cell
+        self.cell_xy = np.empty((maze.map_length, maze.map_width, 2))
+        for i in range(maze.map_length):
+            for j in range(maze.map_width):
+                self.cell_xy[i, j] = maze.cell_rowcol_to_xy(np.array([i, j]))
 
         self.gains = gains
         self.waypoint_threshold = waypoint_threshold
+        self.waypoint_threshold_sq = waypoint_threshold**2
         self.waypoint_targets = None
 
+        # Waypoint position noise is sampled in batches
+        self.noise_buffer_size = 1024
+        self.waypoint_noise = np.random.uniform(size=(self.noise_buffer_size, 2))*0.2
+        self.noise_id = 0
+
+    def sample_waypoint_noise(self):
+        noise = self.waypoint_noise[self.noise_id]
+        self.noise_id += 1
+        # Refill the buffer once every sample has been used
+        if self.noise_id == self.noise_buffer_size:
+            self.waypoint_noise = np.random.uniform(size=(self.noise_buffer_size, 2))*0.2
+            self.noise_id = 0
+        return noise
+
     def compute_action(self, obs):
-        # Check if we need to generate new waypoint path due to change in global target
-        if np.linalg.norm(self.global_target_xy - obs['desired_goal']) > 1e-3 or self.waypoint_targets is None:
+        observation, achieved_goal, desired_goal = obs['observation'], obs['achieved_goal'], obs['desired_goal']
+
+        # Check if we need to generate new waypoint path due to change in global target.
+        # The goal stays the same until it is reached, so an exact comparison is enough.
+        if self.waypoint_targets is None or not np.array_equal(self.global_target_xy, desired_goal):
             # Convert xy to cell id
-            achieved_goal_cell = tuple(self.maze.cell_xy_to_rowcol(obs['achieved_goal']))
-            self.global_target_id = tuple(self.maze.cell_xy_to_rowcol(obs['desired_goal']))
-            self.global_target_xy = obs['desired_goal']
+            achieved_goal_cell = tuple(self.maze.cell_xy_to_rowcol(achieved_goal))
+            self.global_target_id = tuple(self.maze.cell_xy_to_rowcol(desired_goal))
+            self.global_target_xy = desired_goal.copy()
 
             self.waypoint_targets = self.maze_solver.generate_path(achieved_goal_cell, self.global_target_id)
 
@@ -205,23 +268,24 @@ class WaypointController:
             # If empty then the ball is already in the target cell location
             if self.waypoint_targets:
                 self.current_control_target_id = self.waypoint_targets[achieved_goal_cell]
-                self.current_control_target_xy = self.maze.cell_rowcol_to_xy(np.array(self.current_control_target_id))
+                self.current_control_target_xy = self.cell_xy[self.current_control_target_id]
             else:
                 self.waypoint_targets[self.current_control_target_id] = self.current_control_target_id
                 self.current_control_target_id = self.global_target_id
                 self.current_control_target_xy = self.global_target_xy
 
         # Check if we need to go to the next waypoint
-        dist = np.linalg.norm(self.current_control_target_xy - obs['achieved_goal'])
-        if dist <= self.waypoint_threshold and self.current_control_target_id != self.global_target_id:
+        # Compare squared distances to avoid the square root
+        dx, dy = self.current_control_target_xy - achieved_goal
+        if dx*dx + dy*dy <= self.waypoint_threshold_sq and self.current_control_target_id != self.global_target_id:
             self.current_control_target_id = self.waypoint_targets[self.current_control_target_id]
             # If target is global goal go directly to goal position
             if self.current_control_target_id == self.global_target_id:
                 self.current_control_target_xy = self.global_target_xy
             else:
-                self.current_control_target_xy = self.maze.cell_rowcol_to_xy(np.array(self.current_control_target_id)) - np.random.uniform(size=(2,))*0.2
+                self.current_control_target_xy = self.cell_xy[self.current_control_target_id] - self.sample_waypoint_noise()
 
-        action = self.gains['p'] * (self.current_control_target_xy - obs['achieved_goal']) + self.gains['d'] * obs['observation'][2:]
+        action = self.gains['p'] * (self.current_control_target_xy - achieved_goal) + self.gains['d'] * observation[2:]
         action = np.clip(action, -1, 1)
 
         return action
@@ -249,17 +313,14 @@ class PointMazeStepDataCallback(StepDataCallback):
     returns a True 'succes' key in 'infos'. This way we can divide the Minari dataset into different trajectories.
     """
     def __call__(self, env, obs, info, action=None, rew=None, terminated=None, truncated=None):
-        qpos = obs['observation'][:2]
-        qvel = obs['observation'][2:]
-        goal = obs['desired_goal']
-
         step_data = super().__call__(env, obs, info, action, rew, terminated, truncated)
 
-        if step_data['infos']['success']:
+        infos = step_data['infos']
+        if infos['success']:
             step_data['truncations'] = True
-        step_data['infos']['qpos'] = qpos
-        step_data['infos']['qvel'] = qvel
-        step_data['infos']['goal'] = goal
+        # qpos and qvel are views of the observation array, no data is copied
+        observation = obs['observation']
+        infos.update(qpos=observation[:2], qvel=observation[2:], goal=obs['desired_goal'])
 
         return step_data
 
@@ -299,10 +360,18 @@ obs, _ = collector_env.reset(seed=123)
 
 waypoint_controller = WaypointController(maze=env.maze)
 
+# The action noise is sampled in batches of 65536 steps instead of once per step
+noise_buffer_size = 1 << 16
+noise_id = noise_buffer_size
+
 for n_step in range(int(1e6)):
     action = waypoint_controller.compute_action(obs)
     # Add some noise to each step action
-    action += np.random.randn(*action.shape)*0.5
+    if noise_id == noise_buffer_size:
+        action_noise = np.random.randn(noise_buffer_size, *action.shape)*0.5
+        noise_id = 0
+    action += action_noise[noise_id]
+    noise_id += 1
 
     obs, rew, terminated, truncated, info = collector_env.step(action)
     if (n_step + 1) % 200000 == 0: